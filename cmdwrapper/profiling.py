@@ -0,0 +1,210 @@
+# **************************************************************************
+# *
+# * Authors:     Ruben Sanchez Garcia (ruben.sanchez-garcia@stats.ox.ac.uk)
+# *
+# * Ruben Sanchez Garcia
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Helpers to profile protocol steps (cProfile) and wrapped commands (py-spy if
+available, otherwise sampling of /proc for the whole process tree). Command
+profiles are written as flamegraph-compatible collapsed stacks
+(<prefix>.collapsed) plus a top-N hotspot table (<prefix>_hotspots.txt) and
+the CPU time of each process (<prefix>_processes.txt).
+"""
+import cProfile
+import os
+import pstats
+import shutil
+import subprocess
+import threading
+from collections import Counter
+
+PROFILE_TOP_N = 30
+SAMPLING_RATE = 100  # samples per second for py-spy
+PROC_SAMPLING_INTERVAL = 0.05  # seconds between /proc samples
+
+
+def profileCall(outputPrefix, func, *args, **kwargs):
+    """ Run func under cProfile, writing <outputPrefix>.prof and a table with
+    the top functions by cumulative time to <outputPrefix>_hotspots.txt """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(outputPrefix + ".prof")
+        with open(outputPrefix + "_hotspots.txt", "w") as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+
+
+def writeCollapsedHotspots(collapsedFname, hotspotsFname, topN=PROFILE_TOP_N):
+    """ Write the frames with most samples of a collapsed stacks file, both as
+    leaf (self) and anywhere in the stack (total) """
+    selfSamples, totalSamples = Counter(), Counter()
+    nSamples = 0
+    with open(collapsedFname) as f:
+        for line in f:
+            stack, _, count = line.rstrip().rpartition(" ")
+            if not stack or not count.isdigit():
+                continue
+            count = int(count)
+            frames = stack.split(";")
+            nSamples += count
+            selfSamples[frames[-1]] += count
+            for frame in set(frames):
+                totalSamples[frame] += count
+
+    with open(hotspotsFname, "w") as f:
+        f.write(f"{nSamples} samples\n\n")
+        for title, counter in [("Self", selfSamples), ("Total", totalSamples)]:
+            f.write(f"{title:>8} {'%':>6}  frame\n")
+            for frame, count in counter.most_common(topN):
+                f.write(f"{count:>8} {100. * count / max(nSamples, 1):>6.2f}  {frame}\n")
+            f.write("\n")
+
+
+def _readProcStat(pid):
+    """ (ppid, comm, state, cpu ticks) of a process, from /proc/<pid>/stat """
+    with open(f"/proc/{pid}/stat") as f:
+        stat = f.read()
+    comm = stat[stat.index("(") + 1:stat.rindex(")")]
+    fields = stat[stat.rindex(")") + 2:].split()
+    return int(fields[1]), comm, fields[0], int(fields[11]) + int(fields[12])
+
+
+def _readWchan(pid):
+    try:
+        with open(f"/proc/{pid}/wchan") as f:
+            wchan = f.read().strip()
+    except OSError:
+        return ""
+    return "" if wchan == "0" else wchan
+
+
+class CommandProfiler:
+    """ Sample the process tree rooted at pid until stop() is called. The
+    process ancestry, state and CPU time of every process are always sampled
+    from /proc; the collapsed stacks come from py-spy when it is installed
+    and produced a profile, otherwise from these samples. """
+
+    def __init__(self, pid, outputPrefix):
+        self.pid = pid
+        self.outputPrefix = outputPrefix
+        self._pyspy = None
+        self._thread = None
+        self._stopEvent = threading.Event()
+        self._stacks = Counter()
+        self._processes = {}
+
+    def start(self):
+        pyspy = shutil.which("py-spy")
+        if pyspy:
+            self._pyspyLog = open(self.outputPrefix + "_py-spy.log", "w")
+            self._pyspy = subprocess.Popen([pyspy, "record", "--pid", str(self.pid), "--subprocesses",
+                                            "--nonblocking", "--format", "raw",
+                                            "--rate", str(SAMPLING_RATE),
+                                            "--output", self._getPyspyFname()],
+                                           stdout=self._pyspyLog, stderr=subprocess.STDOUT)
+        # Sampled in any case, as py-spy may fail at any point
+        self._thread = threading.Thread(target=self._sampleProc, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        pyspyOk = False
+        if self._pyspy is not None:
+            # py-spy stops by itself when the profiled process exits
+            try:
+                self._pyspy.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._pyspy.terminate()
+                self._pyspy.wait()
+            self._pyspyLog.close()
+            pyspyFname = self._getPyspyFname()
+            pyspyOk = (self._pyspy.returncode == 0 and os.path.exists(pyspyFname)
+                       and os.path.getsize(pyspyFname) > 0)
+            if pyspyOk:
+                os.replace(pyspyFname, self.outputPrefix + ".collapsed")
+            else:
+                print(f"Warning, py-spy failed to profile {self.pid} (exit code {self._pyspy.returncode}, "
+                      f"see {self._pyspyLog.name}), using the /proc samples instead")
+
+        self._stopEvent.set()
+        self._thread.join()
+        self._writeProcProfile(writeCollapsed=not pyspyOk)
+
+        collapsedFname = self.outputPrefix + ".collapsed"
+        if os.path.exists(collapsedFname):
+            writeCollapsedHotspots(collapsedFname, self.outputPrefix + "_hotspots.txt")
+
+    def _getPyspyFname(self):
+        return self.outputPrefix + "_py-spy.collapsed"
+
+    def _sampleProc(self):
+        while not self._stopEvent.is_set():
+            self._sampleProcOnce()
+            self._stopEvent.wait(PROC_SAMPLING_INTERVAL)
+
+    def _sampleProcOnce(self):
+        stats = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    stats[int(entry)] = _readProcStat(entry)
+                except (OSError, ValueError, IndexError):
+                    pass  # The process finished while being read
+
+        # Processes in the tree, with their ancestry from the root
+        chains = {self.pid: [self.pid]} if self.pid in stats else {}
+        pending = list(chains)
+        children = {}
+        for pid, (ppid, _, _, _) in stats.items():
+            children.setdefault(ppid, []).append(pid)
+        while pending:
+            pid = pending.pop()
+            for child in children.get(pid, []):
+                chains[child] = chains[pid] + [child]
+                pending.append(child)
+
+        for pid, chain in chains.items():
+            _, comm, state, ticks = stats[pid]
+            if state == "R":
+                leaf = "[running]"
+            else:
+                wchan = _readWchan(pid)
+                leaf = f"[{state}:{wchan}]" if wchan else f"[{state}]"
+            self._stacks[";".join([stats[p][1] for p in chain] + [leaf])] += 1
+            previous = self._processes.get(pid, (comm, 0, 0))
+            self._processes[pid] = (comm, ticks, previous[2] + (state == "R"))
+
+    def _writeProcProfile(self, writeCollapsed=True):
+        if writeCollapsed:
+            with open(self.outputPrefix + ".collapsed", "w") as f:
+                for stack, count in self._stacks.items():
+                    f.write(f"{stack} {count}\n")
+
+        ticksPerSecond = os.sysconf("SC_CLK_TCK")
+        with open(self.outputPrefix + "_processes.txt", "w") as f:
+            f.write(f"{'pid':>8} {'cpu (s)':>10} {'running':>8}  command\n")
+            processes = sorted(self._processes.items(), key=lambda item: -item[1][1])
+            for pid, (comm, ticks, running) in processes[:PROFILE_TOP_N]:
+                f.write(f"{pid:>8} {ticks / ticksPerSecond:>10.2f} {running:>8}  {comm}\n")
@@ -6,4 +6,5 @@
 from .protocol_genericCmd import GenericCmdProtocol
 from .protocol_removeUnlinkedImages import RemoveUnlinkedImages
 from .protocol_downloadEMDB import DownloadEMDBMap
-from .splitAutorefineParticles import ProtRelionAutorefSplitData
\ No newline at end of file
+from .splitAutorefineParticles import ProtRelionAutorefSplitData
+from .protocol_materializeSplitSubsets import ProtMaterializeSplitSubsets
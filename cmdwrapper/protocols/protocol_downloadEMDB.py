@@ -1,8 +1,3 @@
-import mrcfile
-import requests
-import gzip
-import shutil
-
 from pwem.objects import Volume
 from pyworkflow.protocol import Protocol, params
 
@@ -18,6 +13,12 @@ class DownloadEMDBMap(Protocol):
         self._insertFunctionStep('downloadEMDBMapStep')
 
     def downloadEMDBMapStep(self):
+        import gzip
+        import shutil
+
+        import mrcfile
+        import requests
+
         emdb_id = self.emdbId.get()
         url = f'https://ftp.ebi.ac.uk/pub/databases/emdb/structures/EMD-{emdb_id}/map/emd_{emdb_id}.map.gz'
         print(f"Trying to download from {url}")
@@ -31,9 +31,13 @@ This protocol allow you to run an arbitrary command on an input set of particles
 (or several), and generates a starfile with one or more new metadata columns.
 
 """
+import functools
 import glob
+import json
 import os.path
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import pwem
 from pwem.objects import Volume
@@ -41,10 +45,212 @@ from pyworkflow.protocol import Protocol, params, Integer, MultiPointerParam, Bo
 from pyworkflow.utils import Message, replaceBaseExt
 import pwem.objects as emobj
 from pwem.protocols import ProtProcessParticles, ProtParticles, EMProtocol
-import relion.convert as convert
 from pyworkflow.protocol import constants
 from pyworkflow.plugin import Plugin
 
+from cmdwrapper.profiling import profileCall, CommandProfiler
+
+
+def parsePipeline(text):
+    """ Parse a pipeline spec: a JSON object mapping stage names to
+    {"cmd": str, "inputs": [files], "outputs": [files], "after": [stages]}.
+    A stage depends on the stages listed in "after" and on those producing
+    any of its inputs. Returns a dict name -> stage with a "deps" set. """
+    spec = json.loads(text)
+    if not isinstance(spec, dict) or not spec:
+        raise ValueError("The pipeline must be a non-empty JSON object of stages")
+    producers = {}
+    for name, stage in spec.items():
+        if not isinstance(stage, dict) or not isinstance(stage.get('cmd'), str) or not stage['cmd']:
+            raise ValueError(f"Stage '{name}' needs a 'cmd'")
+        for key in ['inputs', 'outputs', 'after']:
+            value = stage.get(key, [])
+            if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                raise ValueError(f"'{key}' of stage '{name}' must be a list of strings")
+        for fname in stage.get('outputs', []):
+            producers[fname] = name
+
+    stages = {}
+    for name, stage in spec.items():
+        deps = set(stage.get('after', []))
+        deps.update(producers[fname] for fname in stage.get('inputs', []) if fname in producers)
+        deps.discard(name)
+        unknown = deps - set(spec)
+        if unknown:
+            raise ValueError(f"Stage '{name}' depends on unknown stages {sorted(unknown)}")
+        stages[name] = dict(cmd=stage['cmd'], outputs=stage.get('outputs', []), deps=deps)
+
+    # Topological sort to reject cycles
+    sortedStages, remaining = [], dict(stages)
+    while remaining:
+        ready = [name for name, stage in remaining.items() if stage['deps'].issubset(sortedStages)]
+        if not ready:
+            raise ValueError(f"Cyclic dependencies between stages {sorted(remaining)}")
+        for name in ready:
+            sortedStages.append(name)
+            remaining.pop(name)
+    return {name: stages[name] for name in sortedStages}
+
+
+class PipelineRunner:
+    """ Run the stages of a parsed pipeline as their dependencies complete,
+    using up to numberOfThreads threads. runStage(name, stage) runs a stage
+    and raises on failure; outputExists(pattern) tells whether a declared
+    output is there. Every finished stage is checkpointed in checkpointDir,
+    so a later run skips it while its command and outputs are unchanged. """
+
+    def __init__(self, stages, checkpointDir, runStage, outputExists, numberOfThreads=1):
+        self.stages = stages
+        self.checkpointDir = checkpointDir
+        self.runStage = runStage
+        self.outputExists = outputExists
+        self.numberOfThreads = max(1, numberOfThreads or 1)
+
+    def getCheckpoint(self, name):
+        return os.path.join(self.checkpointDir, f"{name}.done")
+
+    def isStageDone(self, name):
+        """ A stage is done if it finished with the same command and its
+        outputs are still there """
+        checkpoint = self.getCheckpoint(name)
+        if not os.path.exists(checkpoint):
+            return False
+        with open(checkpoint) as f:
+            if f.read() != self.stages[name]['cmd']:
+                return False
+        return all(self.outputExists(fname) for fname in self.stages[name]['outputs'])
+
+    def _runStage(self, name):
+        stage = self.stages[name]
+        self.runStage(name, stage)
+        missing = [fname for fname in stage['outputs'] if not self.outputExists(fname)]
+        if missing:
+            raise RuntimeError(f"Stage '{name}' did not produce {missing}")
+        with open(self.getCheckpoint(name), "w") as f:
+            f.write(stage['cmd'])
+
+    def run(self):
+        """ Run the stages not checkpointed by a previous execution. Returns
+        the names of the stages executed. """
+        os.makedirs(self.checkpointDir, exist_ok=True)
+        done = set()
+        for name, stage in self.stages.items():
+            # A stage whose dependencies need to run again has to be re-run too
+            if stage['deps'].issubset(done) and self.isStageDone(name):
+                print(f"Stage '{name}' already done, skipping it")
+                done.add(name)
+        pending = [name for name in self.stages if name not in done]
+        for name in pending:
+            if os.path.exists(self.getCheckpoint(name)):
+                os.remove(self.getCheckpoint(name))
+
+        executed = []
+        running = {}
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.numberOfThreads) as executor:
+            while pending or running:
+                if not errors:
+                    for name in [name for name in pending if self.stages[name]['deps'].issubset(done)]:
+                        if len(running) >= self.numberOfThreads:
+                            break
+                        pending.remove(name)
+                        print(f"Running stage '{name}'", flush=True)
+                        executed.append(name)
+                        running[executor.submit(self._runStage, name)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except Exception as e:
+                        errors.append(f"Stage '{name}' failed: {e}")
+
+        if errors:
+            raise RuntimeError("\n".join(errors))
+        return executed
+
+
+def runCommand(cmd, envvars, prefix='', profilePrefix=None):
+    """ Run cmd in a shell, echoing its stdout and stderr lines with prefix.
+    Both pipes are drained at the same time, so a command writing a lot to
+    stderr cannot block. If profilePrefix is given, the command is profiled
+    with CommandProfiler. Raises RuntimeError with the output if it fails. """
+    import subprocess
+
+    def readStderr():
+        for line in p.stderr:
+            print(prefix + line, end='', flush=True)
+            errorLines.append(line)
+
+    outputLines = []
+    errorLines = []
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=32, env=envvars,
+                          universal_newlines=True, shell=True) as p:
+        profiler = None
+        if profilePrefix is not None:
+            profiler = CommandProfiler(p.pid, profilePrefix).start()
+        stderrThread = threading.Thread(target=readStderr, daemon=True)
+        stderrThread.start()
+        for line in p.stdout:
+            print(prefix + line, end='', flush=True)  # process line here
+            outputLines.append(line)
+        stderrThread.join()
+
+    if profiler is not None:
+        profiler.stop()
+
+    if p.returncode != 0:
+        error = " " + "".join(errorLines)
+        print(error, flush=True)
+        raise RuntimeError("".join(outputLines) + "ERROR:\n" + error)
+
+
+def readVolumeHeader(fname):
+    """ Memory-map an MRC volume to get its sampling rate and dimensions
+    without reading the data. Returns (fname, samplingRate, dims, error),
+    error being None unless the file is not a valid, complete MRC file. """
+    import mrcfile
+    try:
+        with mrcfile.mmap(fname, mode='r') as mrc:
+            header = mrc.header
+            dims = (int(header.nx), int(header.ny), int(header.nz))
+            samplingRate = float(mrc.voxel_size.x)
+    except Exception as e:
+        return fname, None, None, str(e)
+    if samplingRate <= 0:
+        return fname, None, None, f"invalid voxel size {samplingRate}"
+    return fname, samplingRate, dims, None
+
+
+def readVolumeHeaders(volFnames, badVolsFname, numberOfThreads=1):
+    """ Read the headers of volFnames in parallel. Invalid volumes are
+    reported and listed, with the reason, in badVolsFname. Returns
+    (fname, samplingRate, dims) for the valid ones. """
+    with ThreadPoolExecutor(max_workers=max(1, numberOfThreads or 1)) as executor:
+        headers = list(executor.map(readVolumeHeader, volFnames))
+
+    badVols = [(fname, error) for fname, _, _, error in headers if error is not None]
+    if badVols:
+        print(f"Warning, {len(badVols)} output volumes are not valid MRC files and will be skipped:")
+        with open(badVolsFname, "w") as f:
+            for fname, error in badVols:
+                print(f"  {fname}: {error}")
+                f.write(f"{fname}\t{error}\n")
+    return [(fname, samplingRate, dims) for fname, samplingRate, dims, error in headers if error is None]
+
+
+def profiledStep(stepFunc):
+    """ Run the step under cProfile if the protocol profile param is set """
+    @functools.wraps(stepFunc)
+    def wrapper(self, *args, **kwargs):
+        if not self.profile.get():
+            return stepFunc(self, *args, **kwargs)
+        return profileCall(self._getProfilePrefix(stepFunc.__name__), stepFunc, self, *args, **kwargs)
+    return wrapper
+
 
 class GenericCmdProtocol(EMProtocol):
     """
@@ -107,7 +313,27 @@ class GenericCmdProtocol(EMProtocol):
                            'The output starfiles generated by the command '
                            'need to follow the patterns defined at the Outputs section and will be written at '
                            'the extra dir as well. $WORKING_DIR points'
-                           'to the project root directory ($WORKING_DIR/Runs/...')
+                           'to the project root directory ($WORKING_DIR/Runs/...',
+                      condition='not usePipeline')
+
+        form.addParam('usePipeline', BooleanParam,
+                      default=False,
+                      label="Run a pipeline of commands?",
+                      help="Run several named commands with dependencies between them instead of a single "
+                           "command. Independent stages run concurrently within the number of threads.")
+
+        form.addParam('pipeline', params.TextParam,
+                      default=None,
+                      condition='usePipeline',
+                      label='Pipeline',
+                      help='JSON object mapping stage names to {"cmd": ..., "inputs": [...], "outputs": [...], '
+                           '"after": [...]}. A stage runs after the stages listed in "after" and after the '
+                           'stages whose "outputs" include any of its "inputs". $EXTRA_DIR and $WORKING_DIR '
+                           'can be used as in the command. Completed stages are checkpointed, so continuing '
+                           'a failed run only executes the failed stages and their descendants. Example:\n'
+                           '{"a": {"cmd": "prepA.py", "outputs": ["$EXTRA_DIR/a.star"]},\n'
+                           ' "b": {"cmd": "prepB.py", "outputs": ["$EXTRA_DIR/b.star"]},\n'
+                           ' "c": {"cmd": "merge.py", "inputs": ["$EXTRA_DIR/a.star", "$EXTRA_DIR/b.star"]}}')
 
         form.addParam('envVars', params.StringParam,
                       default=None,
@@ -124,6 +350,14 @@ class GenericCmdProtocol(EMProtocol):
                       label='Conda env', allowsNull=True,
                       help='Conda environment to be activated before running the command')
 
+        form.addParam('profile', BooleanParam,
+                      default=False, expertLevel=params.LEVEL_ADVANCED,
+                      label="Profile the execution?",
+                      help="Profile the protocol steps with cProfile and sample the processes launched by the "
+                           "command (with py-spy if installed, otherwise from /proc). Collapsed stacks "
+                           "(flamegraph compatible), .prof files and hotspot tables are written to "
+                           "$EXTRA_DIR/profile")
+
         form.addSection(label=Message.LABEL_OUTPUT)
 
         form.addParam('areThereOutputParts', BooleanParam,
@@ -150,6 +384,15 @@ class GenericCmdProtocol(EMProtocol):
                       label="Output volumes filenames pattern",
                       help='Pattern for the output volumes filenames. Use * as a placeholder for the output number.')
 
+        form.addParam('outputVolumesAsSet', BooleanParam,
+                      default=False,
+                      condition='areThereOutputVols',
+                      label="Register output vols as a set?",
+                      help="If set to True, all the output volumes are registered as a single SetOfVolumes "
+                           "(outputVolumes) instead of one output per volume. The volumes need to be MRC "
+                           "files; their sampling rate is read from the headers and invalid or truncated "
+                           "files are reported and skipped. Headers are read using the protocol threads.")
+
         form.addParam('extraLabels', StringParam,
                       label="Output extra labels", default='',
                       help="Space separated list of Relion labels "
@@ -163,8 +406,9 @@ class GenericCmdProtocol(EMProtocol):
 
 
     def _getDefaultParallel(self):
-        """This protocol doesn't have mpi version"""
-        return (0, 0)
+        """This protocol doesn't have mpi version. Threads are only used to run
+        independent pipeline stages concurrently"""
+        return (1, 0)
 
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
@@ -180,9 +424,21 @@ class GenericCmdProtocol(EMProtocol):
         return self._getExtraPath("volume%d.mrc"%num)
 
 
+    def _getCommands(self):
+        """ Commands that will be executed, one per pipeline stage """
+        if self.usePipeline.get():
+            return [stage['cmd'] for stage in parsePipeline(self.pipeline.get()).values()]
+        return [self.command.get()]
+
+    def _getProfilePrefix(self, name):
+        os.makedirs(self._getExtraPath("profile"), exist_ok=True)
+        return self._getExtraPath("profile", name)
+
+    @profiledStep
     def convertInputStep(self):
+        import relion.convert as convert
 
-        cmd = self.command.get()
+        cmd = " ".join(self._getCommands())
         for i, pointer in enumerate(self.inputParticles):
             inputSet = pointer.get()
             convert.writeSetOfParticles(inputSet,
@@ -206,8 +462,7 @@ class GenericCmdProtocol(EMProtocol):
         s = s.replace("$WORKING_DIR", self.getProject().getPath() + "/")
         return s
 
-    def executeCmd(self):
-
+    def _getEnvVars(self):
         if self.addEnvsToScipion.get():
             envvars = os.environ.copy()
         else:
@@ -222,8 +477,9 @@ class GenericCmdProtocol(EMProtocol):
             for match in matches:
                 name, value = match.split('=', 1)
                 envvars[name] = str(value).rstrip()
+        return envvars
 
-        cmd = self.command.get()
+    def _prepareCmd(self, cmd):
         condaEnv = self.condaEnv.get()
         if condaEnv:
             # cmd = f'eval "$(conda shell.bash hook)" && conda activate {condaEnv} && {cmd}'
@@ -234,38 +490,44 @@ class GenericCmdProtocol(EMProtocol):
                 if not condaActivateCmd.rstrip().endswith("activate"):
                     condaActivateCmd += " conda activate "
             cmd = f'{condaActivateCmd} {condaEnv} && {cmd}'
-        import subprocess
-        print(f"env vars: {envvars}")
         print(cmd)
-        cmd = self.replaceDirs(cmd)
+        return self.replaceDirs(cmd)
+
+    def _runCmd(self, cmd, envvars, prefix='', profileName='command'):
+        profilePrefix = self._getProfilePrefix(profileName) if self.profile.get() else None
+        runCommand(cmd, envvars, prefix=prefix, profilePrefix=profilePrefix)
+
+    @profiledStep
+    def executeCmd(self):
+        envvars = self._getEnvVars()
+        print(f"env vars: {envvars}")
+        if self.usePipeline.get():
+            self._runPipeline(parsePipeline(self.pipeline.get()), envvars)
+            return
+
+        cmd = self._prepareCmd(self.command.get())
         with open(self._getExtraPath("command.txt"), "w") as f:
             f.write(cmd)
+        self._runCmd(cmd, envvars)
 
-        stdout = subprocess.PIPE
-        stderr = subprocess.PIPE
-        output = ""
-        error = " "
-        with subprocess.Popen(cmd, stdout=stdout, stderr=stderr, bufsize=32, env=envvars,
-                              universal_newlines=True, shell=True) as p:
-            for line in p.stdout:
-                print(line, end='', flush=True)  # process line here
-                output += line
-
-            for line in p.stderr:
-                print(line, end='', flush=True)  # process line here
-                error += line
-
-        returncode = p.returncode
-        if hasattr(stderr, "close"):
-            stderr.close()
-        if hasattr(stdout, "close"):
-            stdout.close()
-        if returncode != 0:
-            output += "ERROR:\n" + error
-            print(error, flush=True)
-            raise RuntimeError(output)
+    def _runPipeline(self, stages, envvars):
+        """ Run the pipeline stages, skipping the ones checkpointed by a
+        previous execution. """
+        with open(self._getExtraPath("command.txt"), "w") as f:
+            f.write(self.pipeline.get())
+
+        def runStage(name, stage):
+            cmd = self._prepareCmd(stage['cmd'])
+            self._runCmd(cmd, envvars, prefix=f"[{name}] ", profileName=f"stage_{name}")
+
+        runner = PipelineRunner(stages, self._getExtraPath("pipeline"), runStage,
+                                outputExists=lambda fname: bool(glob.glob(self.replaceDirs(fname))),
+                                numberOfThreads=self.numberOfThreads.get())
+        runner.run()
 
+    @profiledStep
     def createOutputStep(self):
+        import relion.convert as convert
 
         particleFnames = glob.glob(self.replaceDirs(self.outputParticlesFilenames.get()))
         particlesCounter = 0
@@ -295,7 +557,9 @@ class GenericCmdProtocol(EMProtocol):
 
 
         volFnames = glob.glob( self.replaceDirs(self.outputVolumesFilenames.get()))
-        if volFnames:
+        if volFnames and self.outputVolumesAsSet.get():
+            volFnames = self._createOutputVolumesSet(sorted(volFnames))
+        elif volFnames:
             for volFname in volFnames:
                 vol = Volume()
                 vol.setFileName(volFname)
@@ -318,9 +582,55 @@ class GenericCmdProtocol(EMProtocol):
             assert particleFnames, "Error, no valid output particles detected"
         if self.areThereOutputVols.get():
             assert volFnames, "Error, no valid output volumes detected"
+
+    def _createOutputVolumesSet(self, volFnames):
+        """ Register volFnames as a single SetOfVolumes, reading their headers
+        in parallel. Returns the filenames of the valid volumes. """
+        goodVols = readVolumeHeaders(volFnames, self._getExtraPath("badOutputVolumes.txt"),
+                                     numberOfThreads=self.numberOfThreads.get())
+        if not goodVols:
+            return []
+
+        samplingRates = {samplingRate for _, samplingRate, _ in goodVols}
+        if len(samplingRates) > 1:
+            print(f"Warning, output volumes have different sampling rates: {sorted(samplingRates)}")
+        allDims = {dims for _, _, dims in goodVols}
+        if len(allDims) > 1:
+            print(f"Warning, output volumes have different dimensions: {sorted(allDims)}")
+
+        volSet = self._createSetOfVolumes()
+        volSet.setSamplingRate(goodVols[0][1])
+        vol = Volume()
+        for fname, samplingRate, _ in goodVols:
+            vol.setObjId(None)
+            vol.setFileName(fname)
+            vol.setSamplingRate(samplingRate)
+            volSet.append(vol)
+        volSet.write()
+
+        self._defineOutputs(outputVolumes=volSet)
+        if self.useParticles.get():
+            for pointer in self.inputParticles:
+                self._defineSourceRelation(pointer, volSet)
+        if self.useVolumes.get():
+            for pointer in self.inputVolumes:
+                self._defineSourceRelation(pointer, volSet)
+        return [fname for fname, _, _ in goodVols]
+
     # --------------------------- INFO functions -----------------------------------
 
+    def _validate(self):
+        errors = []
+        if self.usePipeline.get():
+            try:
+                parsePipeline(self.pipeline.get() or "")
+            except ValueError as e:
+                errors.append(f"Invalid pipeline: {e}")
+        return errors
+
     def _msg(self):
+        if self.usePipeline.get():
+            return "You have run the pipeline '"+self.pipeline.get()+"'\n Env vars: %s"%self.envVars.get()
         return "You have run the command '"+self.command.get()+"'\n Env vars: %s"%self.envVars.get()
 
     def _summary(self):
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Ruben Sanchez Garcia (ruben.sanchez-garcia@stats.ox.ac.uk
+# *
+# * University of Oxford, Dept. of Statistics
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+
+
+"""
+This protocol copies the images of a virtual (no image copy) autorefine split
+into new stacks, and registers the materialized subsets.
+
+"""
+import os
+
+from pwem.protocols import ProtProcessParticles
+from pyworkflow.protocol import PointerParam
+
+from .splitAutorefineParticles import (writeSubsetStacks, writeSubsetStar, relocateSubsetParticles,
+                                       SQLITE_BATCH_SIZE)
+
+
+class ProtMaterializeSplitSubsets(ProtProcessParticles):
+    """ Protocol to copy the images of a virtual autorefine split into new stacks """
+    _label = 'materialize split subsets'
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputSplitRun', PointerParam,
+                      pointerClass='ProtRelionAutorefSplitData',
+                      label='Select split run',
+                      help='Select a split run executed without copying the particle images.')
+        form.addParallelSection(threads=4, mpi=0)
+
+    def _insertAllSteps(self):
+        self._insertFunctionStep('materializeStep')
+
+    def _validate(self):
+        errors = []
+        splitRun = self.inputSplitRun.get()
+        if splitRun is not None and splitRun.copyImages.get():
+            errors.append("The selected split run already copied the particle images.")
+        return errors
+
+    def _methods(self):
+        return ["The images of the split subsets were copied to new stacks."]
+
+    def materializeStep(self):
+        from starstack.particlesStar import ParticlesStarSet
+
+        splitRun = self.inputSplitRun.get()
+        subsets = []
+        for subsetIndex in range(splitRun.numberOfSubsets.get()):
+            psset = ParticlesStarSet(splitRun.getSubsetStar(subsetIndex))
+            subsetDir = self._getExtraPath(f"subset_{subsetIndex}")
+            os.makedirs(subsetDir, exist_ok=True)
+            subsets.append((psset,
+                            os.path.join(subsetDir, f"particles_{subsetIndex}.star"),
+                            os.path.join(subsetDir, f"particles_{subsetIndex}.mrcs")))
+
+        samplingRate = subsets[0][0].optics_md["rlnImagePixelSize"].iloc[0]
+        print("Writing subset stacks")
+        writeSubsetStacks([(psset.partNum_fname, subsetMrcs) for psset, _, subsetMrcs in subsets],
+                          samplingRate, numberOfWorkers=self.numberOfThreads.get())
+
+        for subsetIndex, (psset, subsetStar, subsetMrcs) in enumerate(subsets):
+            stackName = os.path.basename(subsetMrcs)
+            writeSubsetStar(subsetStar, psset.optics_md, psset.particles_md,
+                            ["%06d@%s" % (i + 1, stackName) for i in range(len(psset))])
+            self._registerSubset(getattr(splitRun, f"outputSubset_{subsetIndex}"),
+                                 subsetIndex, psset.particles_md, subsetMrcs)
+
+    def _registerSubset(self, inputSet, subsetIndex, particles_md, subsetMrcs):
+        """ Copy inputSet pointing each particle to its image in subsetMrcs """
+        outputSet = self._createSetOfParticles(suffix=str(subsetIndex))
+        outputSet.copyInfo(inputSet)
+        for particle in relocateSubsetParticles(inputSet.iterItems(orderBy='id'), particles_md, subsetMrcs):
+            outputSet.append(particle)
+            if outputSet.getSize() % SQLITE_BATCH_SIZE == 0:
+                outputSet.write(properties=False)
+
+        if outputSet.getSize() != len(particles_md):
+            raise RuntimeError(f"Error, only {outputSet.getSize()} of the {len(particles_md)} particles of "
+                               f"subset {subsetIndex} were found in the split run outputs (matching by rlnImageId)")
+        outputSet.write()
+        self._defineOutputs(**{f"outputSubset_{subsetIndex}": outputSet})
+        self._defineTransformRelation(inputSet, outputSet)
@@ -25,22 +25,340 @@
 # *
 # **************************************************************************
 import glob
+import itertools
 import os
 import random
-import starfile
-from pwem import ALIGN_PROJ
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 from pwem.protocols import ProtProcessParticles
 from pyworkflow.protocol import PointerParam, IntParam, BooleanParam
 from pyworkflow.utils import makePath
-from relion.convert import readSetOfParticles
-from starstack.particlesStar import ParticlesStarSet
+
+COPY_CHUNK_SIZE = 5000
+SQLITE_BATCH_SIZE = 10000
+STREAM_CHUNK_SIZE = 100000
+
+
+def _openStackData(fname, mode='r'):
+    """ Memory-map the data block of an mrc(s) file as a (n, ny, nx) array """
+    import mrcfile
+    with mrcfile.open(fname, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        shape = (int(header.nz), int(header.ny), int(header.nx))
+        dtype = mrcfile.utils.data_dtype_from_header(header)
+        offset = mrc.header.nbytes + int(header.nsymbt)
+    return np.memmap(fname, dtype=dtype, mode=mode, offset=offset, shape=shape)
+
+
+def _copyImagesChunk(srcFname, copies):
+    """ Copy images from one source stack into the subset stacks.
+    copies is a list of (srcIdx, dstFname, dstIdx) sorted by srcIdx, so the
+    source stack is read sequentially. """
+    srcData = _openStackData(srcFname, mode='r')
+    dstData = {}
+    for srcIdx, dstFname, dstIdx in copies:
+        if dstFname not in dstData:
+            dstData[dstFname] = _openStackData(dstFname, mode='r+')
+        dstData[dstFname][dstIdx] = srcData[srcIdx]
+    for data in dstData.values():
+        data.flush()
+    return len(copies)
+
+
+def writeSubsetStacks(subsets, samplingRate, numberOfWorkers=1,
+                      chunkSize=COPY_CHUNK_SIZE):
+    """ Write the image stacks of several subsets in a single pass over the
+    source images.
+
+    subsets is a list of (partNum_fname, stackFname) tuples, where
+    partNum_fname is the list of (0-based index, source stack) of the subset
+    particles, as in ParticlesStarSet. Reads are grouped by source stack and
+    sorted by index, so each source stack is read once and its images are
+    scattered to all the subset stacks. Source stacks are processed
+    concurrently by a pool of numberOfWorkers processes.
+    """
+    import mrcfile
+
+    copiesPerSource = {}
+    imgShape = None
+    for partNum_fname, stackFname in subsets:
+        for dstIdx, (srcIdx, srcFname) in enumerate(partNum_fname):
+            copiesPerSource.setdefault(srcFname, []).append((srcIdx, stackFname, dstIdx))
+        if imgShape is None and partNum_fname:
+            imgShape = _openStackData(partNum_fname[0][1]).shape[1:]
+    if imgShape is None:
+        raise ValueError("Error, all the subsets are empty, there are no images to write")
+
+    # Preallocate the output stacks so that workers can fill them in place
+    for partNum_fname, stackFname in subsets:
+        with mrcfile.new_mmap(stackFname, shape=(len(partNum_fname), *imgShape),
+                              mrc_mode=2, overwrite=True) as mrc:
+            mrc.set_image_stack()
+            mrc.voxel_size = samplingRate
+
+    tasks = []
+    for srcFname, copies in copiesPerSource.items():
+        copies.sort()
+        for start in range(0, len(copies), chunkSize):
+            tasks.append((srcFname, copies[start:start + chunkSize]))
+
+    if numberOfWorkers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=numberOfWorkers) as executor:
+            futures = [executor.submit(_copyImagesChunk, *task) for task in tasks]
+            nCopied = sum(f.result() for f in futures)
+    else:
+        nCopied = sum(_copyImagesChunk(*task) for task in tasks)
+    return nCopied
+
+
+def writeSubsetStar(starFname, optics_md, particles_md, imageNames):
+    """ Write a subset STAR file with its rlnImageName column set to imageNames """
+    import starfile
+
+    particles_md = particles_md.copy()
+    particles_md["rlnImageName"] = imageNames
+    star_data = {}
+    if optics_md is not None:
+        star_data["optics"] = optics_md
+    star_data["particles"] = particles_md
+    starfile.write(star_data, starFname, overwrite=True)
+
+
+def getSourcePath(fname, projectPath=None):
+    """ Path used by virtual subsets to refer to an original stack: relative
+    to projectPath if given, absolute otherwise """
+    if projectPath is None:
+        return os.path.abspath(fname)
+    return os.path.relpath(os.path.abspath(fname), os.path.abspath(projectPath))
+
+
+def materializeSubsetStar(starFname, stackFname=None, numberOfWorkers=1):
+    """ Copy the images referenced by a virtual subset STAR file into its own
+    stack and rewrite the STAR file to point at it. Project-relative image
+    paths are resolved from the current directory, so this should be run
+    from the project root. Only the files are changed: the outputSubset_N
+    sets of the split protocol keep pointing at the original stacks, use
+    ProtMaterializeSplitSubsets to get materialized Scipion outputs. """
+    from starstack.particlesStar import ParticlesStarSet
+
+    psset = ParticlesStarSet(starFname)
+    if stackFname is None:
+        stackFname = os.path.splitext(starFname)[0] + ".mrcs"
+    samplingRate = psset.optics_md["rlnImagePixelSize"].iloc[0]
+    writeSubsetStacks([(psset.partNum_fname, stackFname)], samplingRate,
+                      numberOfWorkers=numberOfWorkers)
+    stackName = os.path.basename(stackFname)
+    writeSubsetStar(starFname, psset.optics_md, psset.particles_md,
+                    ["%06d@%s" % (i + 1, stackName) for i in range(len(psset))])
+
+
+def _resolveImageFname(fname, starFname):
+    """ Locate a stack referenced from starFname, as ParticlesStarSet does """
+    if not os.path.isfile(fname):
+        fname = os.path.join(os.path.dirname(starFname), os.path.basename(fname))
+    return fname
+
+
+def _readStarHeader(fileHandle):
+    """ Read a STAR file up to the first row of the particles table (the loop
+    with rlnImageName). Returns the header lines, the labels of the particles
+    table and its first row. """
+    headerLines = []
+    labels = []
+    for line in fileHandle:
+        stripped = line.strip()
+        if stripped.startswith('_'):
+            labels.append(stripped.split()[0][1:])
+        elif stripped.startswith('loop_') or stripped.startswith('data_'):
+            labels = []
+        elif stripped and not stripped.startswith('#') and 'rlnImageName' in labels:
+            return headerLines, labels, line
+        headerLines.append(line)
+    raise ValueError(f"No particles table with rlnImageName found in {fileHandle.name}")
+
+
+def _splitStarRow(line, quotedToken=re.compile(r'"[^"]*"|\'[^\']*\'|\S+')):
+    """ Split a STAR data row into its values, keeping quoted values whole """
+    if '"' in line or "'" in line:
+        return quotedToken.findall(line)
+    return line.split()
+
+
+def _iterStarRowChunks(starFname, chunkSize=STREAM_CHUNK_SIZE):
+    """ Stream the rows of the particles table of a STAR file. The first item
+    yielded is (headerLines, labels), then lists of at most chunkSize rows. """
+    with open(starFname) as f:
+        headerLines, labels, firstRow = _readStarHeader(f)
+        yield headerLines, labels
+        rows = (line for line in itertools.chain([firstRow], f) if line.strip())
+        for chunk in iter(lambda: list(itertools.islice(rows, chunkSize)), []):
+            yield chunk
+
+
+def assignSubsets(rowIdxs, nSubsets, nRows, seed=None):
+    """ Subset of each row. Without seed, rows are split in contiguous blocks.
+    Otherwise, the row indices are hashed (splitmix64) with the seed, so the
+    assignment is reproducible and independent of how the rows are chunked. """
+    rowIdxs = np.asarray(rowIdxs, dtype=np.uint64)
+    if seed is None:
+        rowsPerSubset = max(nRows // nSubsets, 1)
+        return np.minimum(rowIdxs // np.uint64(rowsPerSubset), nSubsets - 1).astype(np.int64)
+    mask = (1 << 64) - 1
+    x = rowIdxs + np.uint64(((seed + 1) * 0x9E3779B97F4A7C15) & mask)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+    return (x % np.uint64(nSubsets)).astype(np.int64)
+
+
+def streamSplitStar(starFname, subsetStars, seed=None, subsetStacks=None,
+                    imagePathFunc=None, chunkSize=STREAM_CHUNK_SIZE):
+    """ Split a particles STAR file into len(subsetStars) subsets without
+    loading it in memory. Rows are read in chunks, assigned with assignSubsets
+    and appended to the subset STAR files as they come.
+
+    If subsetStacks is given, the images are copied to those stacks (one per
+    subset), preallocated after a first pass that counts the rows. Otherwise,
+    rlnImageName keeps pointing at the source stacks, with their paths mapped
+    through imagePathFunc if provided.
+
+    Returns whether the keys are rlnImageId values and, for each subset, the
+    keys of its rows in order (rlnImageId, or the row index in starFname).
+    These keys are the only per-row state kept, 8 bytes per row, so memory
+    grows linearly with the number of rows but not with the STAR metadata.
+    """
+    import mrcfile
+
+    nSubsets = len(subsetStars)
+    chunks = _iterStarRowChunks(starFname, chunkSize)
+    _, labels = next(chunks)
+    nRows = None
+    if seed is None or subsetStacks:
+        nRows = sum(len(chunk) for chunk in chunks)
+    chunks.close()
+
+    imageCol = labels.index('rlnImageName')
+    idCol = labels.index('rlnImageId') if 'rlnImageId' in labels else None
+
+    dstData = None
+    if subsetStacks:
+        with open(starFname) as f:
+            firstImage = _splitStarRow(_readStarHeader(f)[2])[imageCol]
+        firstStack = _resolveImageFname(firstImage.split('@')[1], starFname)
+        with mrcfile.open(firstStack, header_only=True, permissive=True) as mrc:
+            imgShape = (int(mrc.header.ny), int(mrc.header.nx))
+            samplingRate = mrc.voxel_size.x
+        counts = np.zeros(nSubsets, dtype=np.int64)
+        for start in range(0, nRows, chunkSize):
+            rowIdxs = np.arange(start, min(start + chunkSize, nRows))
+            counts += np.bincount(assignSubsets(rowIdxs, nSubsets, nRows, seed=seed), minlength=nSubsets)
+        dstData = []
+        for stackFname, count in zip(subsetStacks, counts):
+            with mrcfile.new_mmap(stackFname, shape=(int(count), *imgShape),
+                                  mrc_mode=2, overwrite=True) as mrc:
+                mrc.set_image_stack()
+                mrc.voxel_size = samplingRate
+            dstData.append(_openStackData(stackFname, mode='r+'))
+        stackNames = [os.path.basename(stackFname) for stackFname in subsetStacks]
+
+    chunks = _iterStarRowChunks(starFname, chunkSize)
+    headerLines, _ = next(chunks)
+    outFiles = [open(subsetStar, 'w') for subsetStar in subsetStars]
+    subsetKeys = [[] for _ in range(nSubsets)]
+    written = np.zeros(nSubsets, dtype=np.int64)
+    srcFname, srcData = None, None
+    imagePaths = {}  # Resolved (or mapped) path of each source stack name
+    try:
+        for outFile in outFiles:
+            outFile.writelines(headerLines)
+        rowIdx = 0
+        for chunk in chunks:
+            subsetIdxs = assignSubsets(np.arange(rowIdx, rowIdx + len(chunk)), nSubsets, nRows, seed=seed)
+            chunkKeys = [[] for _ in range(nSubsets)]
+            for i, (line, subsetIdx) in enumerate(zip(chunk, subsetIdxs)):
+                tokens = _splitStarRow(line)
+                partNum, fname = tokens[imageCol].split('@', 1)
+                if fname not in imagePaths:
+                    imagePath = _resolveImageFname(fname, starFname)
+                    if dstData is None and imagePathFunc is not None:
+                        imagePath = imagePathFunc(imagePath)
+                    imagePaths[fname] = imagePath
+                if dstData is not None:
+                    fname = imagePaths[fname]
+                    if fname != srcFname:
+                        srcFname, srcData = fname, _openStackData(fname, mode='r')
+                    dstData[subsetIdx][written[subsetIdx]] = srcData[int(partNum) - 1]
+                    tokens[imageCol] = "%06d@%s" % (written[subsetIdx] + 1, stackNames[subsetIdx])
+                elif imagePathFunc is not None:
+                    tokens[imageCol] = "%s@%s" % (partNum, imagePaths[fname])
+                written[subsetIdx] += 1
+                outFiles[subsetIdx].write(" ".join(tokens) + "\n")
+                chunkKeys[subsetIdx].append(int(tokens[idCol]) if idCol is not None else rowIdx + i)
+            for keys, newKeys in zip(subsetKeys, chunkKeys):
+                keys.append(np.array(newKeys, dtype=np.int64))
+            rowIdx += len(chunk)
+    finally:
+        for outFile in outFiles:
+            outFile.close()
+        for data in dstData or []:
+            data.flush()
+
+    return idCol is not None, [np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+                               for keys in subsetKeys]
+
+
+def matchSubsetParticles(particles, useImageIds, subsetKeys):
+    """ Match particles, iterated by increasing id, with the subset rows.
+    subsetKeys holds, for each subset, the rlnImageId (or the row position in
+    the STAR file) of its particles in stack order. The keys are sorted once
+    and merged with the particles in a single pass, which takes about 30
+    bytes per key at the peak. Yields (subsetIndex, position in the subset,
+    particle) for every matched particle. """
+    nSubsets = len(subsetKeys)
+    allKeys = np.concatenate(subsetKeys)
+    subsetOf = np.repeat(np.arange(nSubsets, dtype=np.int32), [len(keys) for keys in subsetKeys])
+    positionOf = np.concatenate([np.arange(len(keys), dtype=np.int64) for keys in subsetKeys])
+    order = np.argsort(allKeys, kind='stable')
+    allKeys, subsetOf, positionOf = allKeys[order], subsetOf[order], positionOf[order]
+    del order
+
+    nKeys = len(allKeys)
+    ptr = 0
+    for position, particle in enumerate(particles):
+        key = particle.getObjId() if useImageIds else position
+        while ptr < nKeys and allKeys[ptr] < key:
+            ptr += 1
+        if ptr == nKeys or allKeys[ptr] != key:
+            continue
+        yield int(subsetOf[ptr]), int(positionOf[ptr]), particle
+        ptr += 1
+
+
+def relocateSubsetParticles(particles, particles_md, stackFname):
+    """ Point the particles of a subset, iterated by increasing id, to their
+    image in stackFname, written in the row order of particles_md. Particles
+    are matched with the rows by rlnImageId, as the STAR image paths are the
+    links made by the refine run, not the particle locations. Yields the
+    matched particles. """
+    if "rlnImageId" not in particles_md.columns:
+        raise ValueError("Error, the subset STAR file has no rlnImageId column to match the particles with")
+    imageIds = particles_md["rlnImageId"].to_numpy(dtype=np.int64)
+    for _, position, particle in matchSubsetParticles(particles, True, [imageIds]):
+        particle.setLocation(position + 1, stackFname)
+        yield particle
 
 
 class ProtRelionAutorefSplitData(ProtProcessParticles):
     """ Protocol to split a Relion autorefine run into subsets """
     _label = 'split relion autorefine run particles'
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._sourcePaths = {}
+
     def _defineParams(self, form):
         form.addSection(label='Input')
         form.addParam('inputAutoRefineRun', PointerParam,
@@ -53,13 +371,67 @@ class ProtRelionAutorefSplitData(ProtProcessParticles):
         form.addParam('randomize', BooleanParam, default=True,
                       label="Randomize particle indices?",
                       help="If set to True, particles will be randomly assigned to subsets.")
+        form.addParam('seed', IntParam, default=-1,
+                      condition='randomize',
+                      label="Random seed",
+                      help="Seed used to assign the particles to subsets. Use the same seed to get the "
+                           "same split again. If -1, a random seed is used. The split is only reproducible "
+                           "with the same streaming setting: the in-memory mode shuffles the particles while "
+                           "the streaming mode hashes each row, so they give different splits for the same seed.")
+        form.addParam('streamStar', BooleanParam, default=False,
+                      label="Stream the STAR file?",
+                      help="If set to True, the STAR file is read in chunks and the rows are written to the "
+                           "subset files as they are assigned, so the STAR metadata is never loaded in memory. "
+                           "Only one key per particle (its rlnImageId) is kept to register the output subsets, "
+                           "about 30 bytes per particle at the peak. Recommended for very large datasets. "
+                           "When randomizing, each "
+                           "particle is assigned independently, so subset sizes are only approximately equal.")
+        form.addParam('copyImages', BooleanParam, default=True,
+                      label="Copy particle images?",
+                      help="If set to True, the images of each subset are copied to a new .mrcs stack. "
+                           "If set to False, the subset STAR files point to the original stacks of the "
+                           "autorefine run, so the split only writes metadata. Virtual subsets can be "
+                           "materialized later with the 'materialize split subsets' protocol.")
+        form.addParam('absolutePaths', BooleanParam, default=False,
+                      condition='not copyImages',
+                      label="Use absolute image paths?",
+                      help="If set to True, the virtual subsets refer to the original stacks with absolute "
+                           "paths. Otherwise, paths are relative to the project directory.")
+        form.addParallelSection(threads=4, mpi=0)
 
     def _insertAllSteps(self):
         self._insertFunctionStep('splitRunStep')
 
 
     def _methods(self):
-        return [f"Particles were split into {self.numberOfSubsets.get()} subsets."]
+        methods = [f"Particles were split into {self.numberOfSubsets.get()} subsets."]
+        if not self.copyImages.get():
+            methods.append("Subsets refer to the original particle stacks, images were not copied.")
+        return methods
+
+    def _getSourcePath(self, fname):
+        """ Path used by virtual subsets to refer to an original stack """
+        if fname not in self._sourcePaths:
+            projectPath = None if self.absolutePaths.get() else self.getProject().getPath()
+            self._sourcePaths[fname] = getSourcePath(fname, projectPath)
+        return self._sourcePaths[fname]
+
+    def getSubsetStar(self, subsetIndex):
+        return self._getExtraPath(f"subset_{subsetIndex}", f"particles_{subsetIndex}.star")
+
+    def _getSeed(self):
+        seed = self.seed.get()
+        if seed is None or seed < 0:
+            seed = random.randrange(2 ** 32)
+        print(f"Using random seed {seed}")
+        return seed
+
+    def _getSubsetFnames(self, subsetIndex):
+        subsetStar = self.getSubsetStar(subsetIndex)
+        subsetMrcs = self._getExtraPath(f"subset_{subsetIndex}", f"particles_{subsetIndex}.mrcs")
+        print("Writing here : ", os.path.split(subsetStar)[0])
+        os.makedirs(os.path.split(subsetStar)[0], exist_ok=True)
+        return subsetStar, subsetMrcs
 
     def splitRunStep(self):
         inputParticles = self.inputAutoRefineRun.get().outputParticles
@@ -67,40 +439,93 @@ class ProtRelionAutorefSplitData(ProtProcessParticles):
         list_of_files = glob.glob(os.path.join(extra_path, '*_data.star'))
         latest_file = max(list_of_files, key=os.path.getctime)
 
-        psset = ParticlesStarSet(latest_file)
+        subsetFnames = [self._getSubsetFnames(subsetIndex)
+                        for subsetIndex in range(self.numberOfSubsets.get())]
+        if self.streamStar.get():
+            useImageIds, subsetKeys = self._streamSplit(latest_file, subsetFnames)
+        else:
+            useImageIds, subsetKeys = self._splitInMemory(latest_file, subsetFnames)
+
+        self._registerSubsets(inputParticles, useImageIds, subsetKeys,
+                              [subsetMrcs for _, subsetMrcs in subsetFnames])
+
+    def _streamSplit(self, starFname, subsetFnames):
+        seed = self._getSeed() if self.randomize.get() else None
+        print("Streaming ", starFname)
+        return streamSplitStar(starFname, [subsetStar for subsetStar, _ in subsetFnames], seed=seed,
+                               subsetStacks=([subsetMrcs for _, subsetMrcs in subsetFnames]
+                                             if self.copyImages.get() else None),
+                               imagePathFunc=None if self.copyImages.get() else self._getSourcePath)
+
+    def _splitInMemory(self, starFname, subsetFnames):
+        from starstack.particlesStar import ParticlesStarSet
+
+        psset = ParticlesStarSet(starFname)
+        samplingRate = psset.optics_md["rlnImagePixelSize"].iloc[0]
 
+        nParticles = len(psset)
+        rowPositions = np.arange(nParticles)
         if self.randomize.get():
             print("Shuffling dataset")
-            psset.shuffle()
+            rowPositions = np.random.default_rng(self._getSeed()).permutation(nParticles)
+            psset = psset.createSubset(idxs=rowPositions)
 
-        nSubsets = self.numberOfSubsets.get()
-        nParticles = len(psset.particles_md)
+        nSubsets = len(subsetFnames)
         particlesPerSubset = nParticles // nSubsets
 
+        subsets = []
         for subsetIndex in range(nSubsets):
             start_idx = subsetIndex * particlesPerSubset
             end_idx = start_idx + particlesPerSubset if subsetIndex < nSubsets - 1 else nParticles
-            subsetStar = self._getExtraPath(f"subset_{subsetIndex}", f"particles_{subsetIndex}.star")
-            subsetMrcs = self._getExtraPath(f"subset_{subsetIndex}", f"particles_{subsetIndex}.mrcs")
-            print("Writing here : ", os.path.split(subsetStar)[0])
-            os.makedirs(os.path.split(subsetStar)[0], exist_ok=True)
             print(start_idx, end_idx)
-            psset_subset = psset.createSubset(start_idx, end_idx)
-            scipion_starfile = self._getTmpPath(f"subset_{subsetIndex}_particles.star")
-            psset_subset.save(scipion_starfile,
-                               stackFname=None, overwrite=True, basenameOnlyForNewStar=False)
-            psset_subset.save(subsetStar, stackFname=subsetMrcs, overwrite=True, basenameOnlyForNewStar=True)
-
-            #TODO: This part is not working, the N outputs of the protocol are the same.
-            # outputSet = self._createSetOfParticles()
-            # outputSet.copyInfo(inputParticles)
-            # readSetOfParticles(scipion_starfile, outputSet, alignType=ALIGN_PROJ)
-            # outputs = {}
-            # outputs[f"outputSubset_{subsetIndex}"] = outputSet
-            # self._defineOutputs(**outputs)
-            # print(outputSet)
-        # for n,o in outputs.items():
-        #     print(n,o)
-        #     self._defineOutputs(n=o)
-        #     self._store(o)
-            # self._defineTransformRelation(inputParticles, o)
+            subsets.append((psset.createSubset(start_idx, end_idx), rowPositions[start_idx:end_idx]))
+
+        if self.copyImages.get():
+            print("Writing subset stacks")
+            writeSubsetStacks([(psset_subset.partNum_fname, subsetMrcs)
+                               for (psset_subset, _), (_, subsetMrcs) in zip(subsets, subsetFnames)],
+                              samplingRate, numberOfWorkers=self.numberOfThreads.get())
+
+        for (psset_subset, _), (subsetStar, subsetMrcs) in zip(subsets, subsetFnames):
+            if self.copyImages.get():
+                stackName = os.path.basename(subsetMrcs)
+                imageNames = ["%06d@%s" % (i + 1, stackName) for i in range(len(psset_subset))]
+            else:
+                imageNames = ["%06d@%s" % (partNum + 1, self._getSourcePath(fname))
+                              for partNum, fname in psset_subset.partNum_fname]
+            writeSubsetStar(subsetStar, psset_subset.optics_md, psset_subset.particles_md, imageNames)
+
+        useImageIds = "rlnImageId" in psset.particles_md.columns
+        subsetKeys = [psset_subset.particles_md["rlnImageId"].to_numpy(dtype=np.int64) if useImageIds
+                      else positions for psset_subset, positions in subsets]
+        return useImageIds, subsetKeys
+
+    def _registerSubsets(self, inputParticles, useImageIds, subsetKeys, subsetStacks):
+        """ Define one outputSubset_N SetOfParticles per subset, inserting the
+        matched input particles in batched transactions. Raises if a subset
+        does not get exactly one particle per row of its STAR file. """
+        outputSets = []
+        for subsetIndex in range(len(subsetKeys)):
+            outputSet = self._createSetOfParticles(suffix=str(subsetIndex))
+            outputSet.copyInfo(inputParticles)
+            outputSets.append(outputSet)
+
+        matches = matchSubsetParticles(inputParticles.iterItems(orderBy='id'), useImageIds, subsetKeys)
+        for subsetIndex, position, particle in matches:
+            if self.copyImages.get():
+                particle.setLocation(position + 1, subsetStacks[subsetIndex])
+            outputSet = outputSets[subsetIndex]
+            outputSet.append(particle)
+            if outputSet.getSize() % SQLITE_BATCH_SIZE == 0:
+                outputSet.write(properties=False)
+
+        for subsetIndex, (outputSet, keys) in enumerate(zip(outputSets, subsetKeys)):
+            if outputSet.getSize() != len(keys):
+                raise RuntimeError(f"Error, only {outputSet.getSize()} of the {len(keys)} particles of "
+                                   f"subset {subsetIndex} were found in the input particles "
+                                   f"(matching by {'rlnImageId' if useImageIds else 'row position'})")
+
+        for subsetIndex, outputSet in enumerate(outputSets):
+            outputSet.write()
+            self._defineOutputs(**{f"outputSubset_{subsetIndex}": outputSet})
+            self._defineTransformRelation(inputParticles, outputSet)
@@ -1,4 +1,6 @@
 
+import json
+import os
 from glob import glob
 
 from pyworkflow.tests import setupTestProject, DataSet
@@ -51,3 +53,38 @@ class TestGenericCmd(TestRelionBase):
 
         output.close()
 
+    def test_pipeline(self):
+        addColumn = ('scipion python -c "import starfile; data = starfile.read(\'%s\');'
+                     'data[\'particles\'][\'%s\']=%s; starfile.write(data, \'%s\')"')
+        pipeline = {
+            "first": {"cmd": addColumn % ('$EXTRA_DIR/particles0.star', 'firstMetadata', '1.',
+                                          '$EXTRA_DIR/first.star'),
+                      "outputs": ["$EXTRA_DIR/first.star"]},
+            "second": {"cmd": "sleep 1 && ls $EXTRA_DIR/particles0.star"},
+            "merge": {"cmd": addColumn % ('$EXTRA_DIR/first.star', 'mergedMetadata', '2.',
+                                          '$EXTRA_DIR/outputParticles0.star'),
+                      "inputs": ["$EXTRA_DIR/first.star"],
+                      "after": ["second"]},
+        }
+        genericCmd = self.newProtocol(GenericCmdProtocol,
+                                      useParticles=True,
+                                      useVolumes=False,
+                                      condaEnv=None,
+                                      usePipeline=True,
+                                      pipeline=json.dumps(pipeline),
+                                      extraLabels='firstMetadata mergedMetadata',
+                                      areThereOutputVols=False,
+                                      numberOfThreads=2,
+                                      )
+
+        genericCmd.inputParticles.set([self.protImport.outputParticles])
+        genericCmd = self.launchProtocol(genericCmd)
+        for name in pipeline:
+            self.assertTrue(os.path.exists(genericCmd._getExtraPath("pipeline", f"{name}.done")),
+                            msg=f"Error, stage {name} was not checkpointed")
+        output = genericCmd.outputParticles0
+        first = output.getFirstItem()
+        self.assertAlmostEqual(first._firstMetadata.get(), 1.0)
+        self.assertAlmostEqual(first._mergedMetadata.get(), 2.0)
+
+        output.close()
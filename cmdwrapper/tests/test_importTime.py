@@ -0,0 +1,41 @@
+import json
+import subprocess
+import sys
+import unittest
+
+# Modules that should only be loaded when a protocol step runs
+HEAVY_MODULES = ['relion.convert', 'starstack', 'starfile', 'mrcfile', 'requests']
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import pwem.protocols
+baseline = time.perf_counter() - start
+heavy = [m for m in %r if m in sys.modules]
+start = time.perf_counter()
+import cmdwrapper.protocols
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(baseline=baseline, elapsed=elapsed,
+                      loaded=[m for m in %r if m in sys.modules and m not in heavy])))
+""" % (HEAVY_MODULES, HEAVY_MODULES)
+
+
+class TestImportTime(unittest.TestCase):
+
+    def _importProtocols(self):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                         universal_newlines=True)
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_heavyModulesNotLoaded(self):
+        result = self._importProtocols()
+        self.assertEqual(result['loaded'], [],
+                         msg="Error, importing cmdwrapper.protocols loads %s" % result['loaded'])
+
+    def test_importTime(self):
+        """ Report only: wall-clock times are too noisy to assert on """
+        results = [self._importProtocols() for _ in range(3)]
+        baseline = min(result['baseline'] for result in results)
+        elapsed = min(result['elapsed'] for result in results)
+        print("pwem.protocols import time: %.3f s, cmdwrapper.protocols on top of it: %.3f s (%.0f%%)"
+              % (baseline, elapsed, 100. * elapsed / max(baseline, 1e-6)))
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mrcfile
+import numpy as np
+
+from cmdwrapper.protocols.protocol_genericCmd import readVolumeHeader, readVolumeHeaders
+
+
+class TestReadVolumeHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.goodFnames = []
+        for i in range(3):
+            fname = os.path.join(self.tmpDir, f"outputVolume{i}.mrc")
+            mrcfile.write(fname, np.zeros((4, 6, 8), dtype=np.float32), voxel_size=2.5)
+            self.goodFnames.append(fname)
+
+        self.truncatedFname = os.path.join(self.tmpDir, "outputVolume3.mrc")
+        mrcfile.write(self.truncatedFname, np.zeros((4, 6, 8), dtype=np.float32), voxel_size=2.5)
+        with open(self.truncatedFname, "r+b") as f:
+            f.truncate(os.path.getsize(self.truncatedFname) - 100)
+
+        self.noVoxelSizeFname = os.path.join(self.tmpDir, "outputVolume4.mrc")
+        mrcfile.write(self.noVoxelSizeFname, np.zeros((4, 6, 8), dtype=np.float32))
+
+        self.badVolsFname = os.path.join(self.tmpDir, "badOutputVolumes.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_readVolumeHeader(self):
+        self.assertEqual(readVolumeHeader(self.goodFnames[0]), (self.goodFnames[0], 2.5, (8, 6, 4), None))
+        for fname in [self.truncatedFname, self.noVoxelSizeFname]:
+            _, samplingRate, dims, error = readVolumeHeader(fname)
+            self.assertIsNone(samplingRate)
+            self.assertIsNone(dims)
+            self.assertTrue(error)
+
+    def test_badVolumesReported(self):
+        fnames = self.goodFnames + [self.truncatedFname, self.noVoxelSizeFname]
+        goodVols = readVolumeHeaders(fnames, self.badVolsFname, numberOfThreads=2)
+
+        self.assertEqual(goodVols, [(fname, 2.5, (8, 6, 4)) for fname in self.goodFnames])
+        with open(self.badVolsFname) as f:
+            badFnames = [line.split("\t")[0] for line in f]
+        self.assertEqual(badFnames, [self.truncatedFname, self.noVoxelSizeFname])
+
+    def test_allValid(self):
+        goodVols = readVolumeHeaders(self.goodFnames, self.badVolsFname)
+        self.assertEqual(len(goodVols), len(self.goodFnames))
+        self.assertFalse(os.path.exists(self.badVolsFname))
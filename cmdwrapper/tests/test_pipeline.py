@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from cmdwrapper.protocols.protocol_genericCmd import parsePipeline, PipelineRunner, runCommand
+
+
+class TestParsePipeline(unittest.TestCase):
+
+    def test_dependencies(self):
+        stages = parsePipeline(json.dumps({
+            "merge": {"cmd": "merge", "inputs": ["a.star", "b.star", "external.star"]},
+            "a": {"cmd": "prepA", "outputs": ["a.star"]},
+            "b": {"cmd": "prepB", "outputs": ["b.star"], "after": ["a"]},
+        }))
+        self.assertEqual(list(stages), ["a", "b", "merge"])
+        self.assertEqual(stages["a"]["deps"], set())
+        self.assertEqual(stages["b"]["deps"], {"a"})
+        self.assertEqual(stages["merge"]["deps"], {"a", "b"})
+
+    def _assertInvalid(self, spec, message):
+        with self.assertRaises(ValueError) as context:
+            parsePipeline(spec if isinstance(spec, str) else json.dumps(spec))
+        self.assertIn(message, str(context.exception))
+
+    def test_invalid(self):
+        self._assertInvalid("", "Expecting value")
+        self._assertInvalid({}, "non-empty")
+        self._assertInvalid({"a": {"outputs": ["a.star"]}}, "needs a 'cmd'")
+        self._assertInvalid({"a": {"cmd": "x", "after": ["b"]}}, "unknown stages ['b']")
+        self._assertInvalid({"a": {"cmd": "x", "after": ["b"]},
+                             "b": {"cmd": "y", "inputs": ["c.star"]},
+                             "c": {"cmd": "z", "outputs": ["c.star"], "after": ["a"]}},
+                            "Cyclic dependencies")
+
+    def test_notLists(self):
+        self._assertInvalid({"a": {"cmd": "x", "outputs": "foo"}}, "'outputs' of stage 'a'")
+        self._assertInvalid({"a": {"cmd": "x"}, "b": {"cmd": "y", "after": "a"}}, "'after' of stage 'b'")
+        self._assertInvalid({"a": {"cmd": "x", "inputs": [1]}}, "'inputs' of stage 'a'")
+
+
+class TestPipelineRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.failing = {"b"}
+        self.notProduced = set()
+        self.spec = {
+            "a": {"cmd": "a", "outputs": ["a.out"]},
+            "b": {"cmd": "b", "outputs": ["b.out"], "after": ["a"]},
+            "c": {"cmd": "c", "inputs": ["b.out"], "outputs": ["c.out"]},
+            "d": {"cmd": "d", "outputs": ["d.out"]},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _runStage(self, name, stage):
+        if name in self.failing:
+            raise RuntimeError("failed on purpose")
+        for fname in set(stage['outputs']) - self.notProduced:
+            open(os.path.join(self.tmpDir, fname), "w").close()
+
+    def _run(self, numberOfThreads=2):
+        runner = PipelineRunner(parsePipeline(json.dumps(self.spec)), os.path.join(self.tmpDir, "pipeline"),
+                                self._runStage,
+                                outputExists=lambda fname: os.path.exists(os.path.join(self.tmpDir, fname)),
+                                numberOfThreads=numberOfThreads)
+        return runner.run()
+
+    def test_continueAfterFailure(self):
+        with self.assertRaises(RuntimeError):
+            self._run()
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir, "c.out")))
+
+        self.failing = set()
+        self.assertEqual(sorted(self._run()), ["b", "c"])
+        self.assertEqual(self._run(), [])
+
+    def test_rerunChangedStage(self):
+        self.failing = set()
+        self._run(numberOfThreads=1)
+        self.spec["b"]["cmd"] = "b --new-option"
+        self.assertEqual(sorted(self._run()), ["b", "c"])
+
+    def test_rerunMissingOutput(self):
+        self.failing = set()
+        self._run()
+        os.remove(os.path.join(self.tmpDir, "a.out"))
+        self.assertEqual(sorted(self._run()), ["a", "b", "c"])
+
+    def test_missingOutputFails(self):
+        self.failing = set()
+        self.notProduced = {"d.out"}
+        with self.assertRaises(RuntimeError) as context:
+            self._run()
+        self.assertIn("did not produce", str(context.exception))
+
+
+class TestRunCommand(unittest.TestCase):
+
+    def _runCommand(self, code):
+        """ Run a python snippet through runCommand in a thread, failing
+        instead of hanging if the command blocks. Returns the raised error. """
+        errors = []
+
+        def run():
+            try:
+                runCommand(f'"{sys.executable}" -c "{code}"', dict(os.environ), prefix="[test] ")
+            except RuntimeError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=60)
+        self.assertFalse(thread.is_alive(), "The command blocked")
+        return errors[0] if errors else None
+
+    def test_largeStderr(self):
+        """ More than a pipe buffer written to stderr before stdout """
+        error = self._runCommand("import sys; sys.stderr.write('e' * 500000 + 'last error'); "
+                                 "print('done'); sys.exit(3)")
+        self.assertIsNotNone(error)
+        self.assertIn("done", str(error))
+        self.assertIn("last error", str(error))
+
+    def test_success(self):
+        self.assertIsNone(self._runCommand("import sys; sys.stderr.write('warning' * 50000); print('done')"))
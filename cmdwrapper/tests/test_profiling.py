@@ -0,0 +1,77 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+from cmdwrapper.profiling import writeCollapsedHotspots, _readProcStat, CommandProfiler
+
+
+class TestCollapsedHotspots(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_hotspots(self):
+        collapsedFname = os.path.join(self.tmpDir, "command.collapsed")
+        hotspotsFname = os.path.join(self.tmpDir, "command_hotspots.txt")
+        with open(collapsedFname, "w") as f:
+            f.write("main;read;parse 6\n"
+                    "main;read 3\n"
+                    "main;write file (1) 1\n"
+                    "malformed line\n")
+
+        writeCollapsedHotspots(collapsedFname, hotspotsFname, topN=2)
+
+        with open(hotspotsFname) as f:
+            sections = f.read().split("\n\n")
+        self.assertEqual(sections[0], "10 samples")
+        selfRows = [line.split() for line in sections[1].splitlines()[1:]]
+        self.assertEqual([(row[0], row[-1]) for row in selfRows], [("6", "parse"), ("3", "read")])
+        self.assertEqual(selfRows[0][1], "60.00")
+        totalRows = [line.split() for line in sections[2].splitlines()[1:]]
+        self.assertEqual([(row[0], row[-1]) for row in totalRows], [("10", "main"), ("9", "read")])
+
+
+class TestProcSampling(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.exists("/proc/self/stat"), "requires /proc")
+    def test_readProcStat(self):
+        ppid, comm, state, ticks = _readProcStat(os.getpid())
+        self.assertEqual(ppid, os.getppid())
+        self.assertTrue(comm)
+        self.assertEqual(state, "R")
+        self.assertGreaterEqual(ticks, 0)
+
+    def _profileSleep(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        prefix = os.path.join(tmpDir, "command")
+        with subprocess.Popen([sys.executable, "-c", "import subprocess; subprocess.call(['sleep', '0.5'])"]) as p:
+            profiler = CommandProfiler(p.pid, prefix).start()
+        profiler.stop()
+
+        # The process table always comes from the /proc samples
+        with open(prefix + "_processes.txt") as f:
+            self.assertIn("sleep", f.read())
+        with open(prefix + ".collapsed") as f:
+            self.assertTrue(f.read().strip())
+        self.assertTrue(os.path.exists(prefix + "_hotspots.txt"))
+        return prefix
+
+    @unittest.skipUnless(os.path.exists("/proc/self/stat"), "requires /proc")
+    def test_profileCommand(self):
+        self._profileSleep()
+
+    @unittest.skipUnless(os.path.exists("/proc/self/stat") and shutil.which("false"), "requires /proc")
+    def test_pyspyFailure(self):
+        """ A py-spy that exits with an error falls back to the /proc samples """
+        with unittest.mock.patch("shutil.which", return_value=shutil.which("false")):
+            prefix = self._profileSleep()
+        with open(prefix + ".collapsed") as f:
+            self.assertIn("sleep", f.read())
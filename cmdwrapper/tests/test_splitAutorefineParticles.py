@@ -0,0 +1,287 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mrcfile
+import numpy as np
+import pandas as pd
+import starfile
+
+from cmdwrapper.protocols.splitAutorefineParticles import (writeSubsetStacks, writeSubsetStar,
+                                                           materializeSubsetStar, getSourcePath,
+                                                           matchSubsetParticles, relocateSubsetParticles,
+                                                           streamSplitStar, assignSubsets)
+
+
+def writeSyntheticStacks(dirname, sizes, shape=(8, 8), samplingRate=1.5):
+    """ Write random .mrcs stacks named after the keys of sizes. Returns fname -> images """
+    images = {}
+    for name, n in sizes.items():
+        fname = os.path.join(dirname, name)
+        images[fname] = np.random.rand(n, *shape).astype(np.float32)
+        mrcfile.write(fname, images[fname], voxel_size=samplingRate)
+    return images
+
+
+def syntheticOptics(samplingRate=1.5, size=8):
+    return pd.DataFrame({"rlnOpticsGroup": [1], "rlnOpticsGroupName": ["opticsGroup1"],
+                         "rlnImagePixelSize": [samplingRate], "rlnImageSize": [size], "rlnImageDimensionality": [2]})
+
+
+class TestWriteSubsetStacks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.images = writeSyntheticStacks(self.tmpDir, {"a.mrcs": 20, "b.mrcs": 13})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _checkSubsets(self, numberOfWorkers, chunkSize):
+        partNum_fname = [(i, fname) for fname, imgs in self.images.items() for i in range(len(imgs))]
+        np.random.RandomState(0).shuffle(partNum_fname)
+        subsets = [(partNum_fname[:10], os.path.join(self.tmpDir, "s0.mrcs")),
+                   (partNum_fname[10:], os.path.join(self.tmpDir, "s1.mrcs"))]
+
+        nCopied = writeSubsetStacks(subsets, 1.5, numberOfWorkers=numberOfWorkers, chunkSize=chunkSize)
+
+        self.assertEqual(nCopied, len(partNum_fname))
+        for subset, stackFname in subsets:
+            with mrcfile.open(stackFname) as mrc:
+                self.assertAlmostEqual(float(mrc.voxel_size.x), 1.5, places=5)
+                data = mrc.data.reshape(-1, 8, 8)
+                self.assertEqual(len(data), len(subset))
+                for dstIdx, (srcIdx, srcFname) in enumerate(subset):
+                    np.testing.assert_array_equal(data[dstIdx], self.images[srcFname][srcIdx])
+
+    def test_serial(self):
+        self._checkSubsets(numberOfWorkers=1, chunkSize=7)
+
+    def test_parallel(self):
+        self._checkSubsets(numberOfWorkers=2, chunkSize=7)
+
+    def test_emptySubsets(self):
+        with self.assertRaises(ValueError):
+            writeSubsetStacks([([], os.path.join(self.tmpDir, "s0.mrcs"))], 1.5)
+
+
+class TestVirtualSubsets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.oldCwd = os.getcwd()
+        os.chdir(self.tmpDir)  # Acts as the project directory
+        os.makedirs("Runs/extract")
+        self.images = writeSyntheticStacks("Runs/extract", {"a.mrcs": 10, "b.mrcs": 5})
+
+    def tearDown(self):
+        os.chdir(self.oldCwd)
+        shutil.rmtree(self.tmpDir)
+
+    def test_getSourcePath(self):
+        fname = "Runs/extract/a.mrcs"
+        self.assertEqual(getSourcePath(fname), os.path.abspath(fname))
+        self.assertEqual(getSourcePath(fname, projectPath=self.tmpDir), fname)
+        self.assertEqual(getSourcePath(os.path.abspath(fname), projectPath="."), fname)
+
+    def _checkMaterialize(self, projectPath):
+        rows = [(3, "Runs/extract/a.mrcs"), (0, "Runs/extract/b.mrcs"), (7, "Runs/extract/a.mrcs")]
+        starFname = "subset_0.star"
+        particles_md = pd.DataFrame({"rlnImageName": [""] * len(rows), "rlnOpticsGroup": 1,
+                                     "rlnAngleRot": np.arange(len(rows), dtype=float)})
+        writeSubsetStar(starFname, syntheticOptics(), particles_md,
+                        ["%06d@%s" % (i + 1, getSourcePath(fname, projectPath)) for i, fname in rows])
+
+        materializeSubsetStar(starFname)
+
+        star = starfile.read(starFname)
+        self.assertIn("optics", star)
+        self.assertEqual(list(star["particles"]["rlnImageName"]),
+                         ["%06d@subset_0.mrcs" % (i + 1) for i in range(len(rows))])
+        data = mrcfile.read("subset_0.mrcs").reshape(-1, 8, 8)
+        for dstIdx, (srcIdx, fname) in enumerate(rows):
+            np.testing.assert_array_equal(data[dstIdx], self.images[fname][srcIdx])
+
+    def test_materializeProjectRelative(self):
+        self._checkMaterialize(projectPath=".")
+
+    def test_materializeAbsolute(self):
+        self._checkMaterialize(projectPath=None)
+
+
+class FakeParticle:
+    def __init__(self, objId, location=None):
+        self.objId = objId
+        self.location = location
+
+    def getObjId(self):
+        return self.objId
+
+    def getLocation(self):
+        return self.location
+
+    def setLocation(self, index, fname):
+        self.location = (index, fname)
+
+
+class TestMatchSubsetParticles(unittest.TestCase):
+    """ Registration of the subsets of an autorefine-like input: particle ids
+    with gaps, as rlnImageId in a shuffled STAR file """
+
+    def setUp(self):
+        self.particles = [FakeParticle(objId) for objId in [1, 2, 4, 5, 8, 9, 10, 13, 14, 20]]
+        ids = np.array([p.getObjId() for p in self.particles])
+        self.perm = np.random.RandomState(1).permutation(len(ids))
+        self.subsetIds = [ids[self.perm[:4]], ids[self.perm[4:7]], ids[self.perm[7:]]]
+
+    def test_matchByImageId(self):
+        matches = list(matchSubsetParticles(self.particles, True, self.subsetIds))
+        self.assertEqual(len(matches), len(self.particles))
+        for subsetIndex, position, particle in matches:
+            self.assertEqual(self.subsetIds[subsetIndex][position], particle.getObjId())
+
+    def test_matchByPosition(self):
+        subsetPositions = [self.perm[:4], self.perm[4:7], self.perm[7:]]
+        matches = list(matchSubsetParticles(self.particles, False, subsetPositions))
+        self.assertEqual(len(matches), len(self.particles))
+        for subsetIndex, position, particle in matches:
+            self.assertIs(self.particles[subsetPositions[subsetIndex][position]], particle)
+
+    def test_missingParticles(self):
+        """ Rows without a particle are not matched, so the protocol can detect them """
+        subsetIds = [np.append(self.subsetIds[0], 7)] + self.subsetIds[1:]
+        matches = list(matchSubsetParticles(self.particles, True, subsetIds))
+        counts = np.bincount([subsetIndex for subsetIndex, _, _ in matches], minlength=3)
+        self.assertEqual(list(counts), [4, 3, 3])
+        self.assertLess(counts[0], len(subsetIds[0]))
+
+
+class TestRelocateSubsetParticles(unittest.TestCase):
+    """ Materialization of a virtual subset whose STAR file points at the
+    links made by the refine run, not at the particle locations """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.oldCwd = os.getcwd()
+        os.chdir(self.tmpDir)  # Acts as the project directory
+        os.makedirs("Runs/extract/extra")
+        os.makedirs("Runs/refine/extra/input")
+        self.images = writeSyntheticStacks("Runs/extract/extra", {"a.mrcs": 10, "b.mrcs": 5})
+        for name in ["a.mrcs", "b.mrcs"]:
+            os.symlink(os.path.abspath(f"Runs/extract/extra/{name}"), f"Runs/refine/extra/input/{name}")
+
+        # Subset rows in shuffled order, particle ids with gaps
+        self.rows = [(3, "a.mrcs", 4), (0, "b.mrcs", 12), (7, "a.mrcs", 8), (1, "a.mrcs", 2)]
+        particles_md = pd.DataFrame({"rlnImageName": [""] * len(self.rows), "rlnOpticsGroup": 1,
+                                     "rlnImageId": [objId for _, _, objId in self.rows]})
+        self.starFname = "Runs/split/extra/subset_0.star"
+        os.makedirs(os.path.dirname(self.starFname))
+        writeSubsetStar(self.starFname, syntheticOptics(), particles_md,
+                        ["%06d@Runs/refine/extra/input/%s" % (i + 1, name) for i, name, _ in self.rows])
+        self.particles = [FakeParticle(objId, (i + 1, f"Runs/extract/extra/{name}"))
+                          for i, name, objId in sorted(self.rows, key=lambda row: row[2])]
+
+    def tearDown(self):
+        os.chdir(self.oldCwd)
+        shutil.rmtree(self.tmpDir)
+
+    def test_symlinkedStacks(self):
+        from starstack.particlesStar import ParticlesStarSet
+        psset = ParticlesStarSet(self.starFname)
+        stackFname = "Runs/materialize/extra/particles_0.mrcs"
+        os.makedirs(os.path.dirname(stackFname))
+        writeSubsetStacks([(psset.partNum_fname, stackFname)], 1.5)
+
+        originalLocations = {p.getObjId(): p.getLocation() for p in self.particles}
+        relocated = list(relocateSubsetParticles(iter(self.particles), psset.particles_md, stackFname))
+
+        self.assertEqual(len(relocated), len(self.rows))
+        data = mrcfile.read(stackFname).reshape(-1, 8, 8)
+        for particle in relocated:
+            index, fname = particle.getLocation()
+            self.assertEqual(fname, stackFname)
+            srcIndex, srcFname = originalLocations[particle.getObjId()]
+            np.testing.assert_array_equal(data[index - 1], self.images[srcFname][srcIndex - 1])
+
+    def test_missingImageIds(self):
+        particles_md = pd.DataFrame({"rlnImageName": ["000001@a.mrcs"]})
+        with self.assertRaises(ValueError):
+            list(relocateSubsetParticles(iter(self.particles), particles_md, "particles_0.mrcs"))
+
+
+class TestStreamSplitStar(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        sizes = {"a.mrcs": 30, "b.mrcs": 20}
+        self.images = writeSyntheticStacks(self.tmpDir, sizes)
+        self.rows = [(i, name) for name, n in sizes.items() for i in range(n)]
+        self.starFname = os.path.join(self.tmpDir, "run_data.star")
+        with open(self.starFname, "w") as f:
+            f.write("\n# version 30001\n\ndata_optics\n\nloop_\n_rlnOpticsGroupName #1\n_rlnOpticsGroup #2\n"
+                    "_rlnImagePixelSize #3\n_rlnImageSize #4\nopticsGroup1 1 1.500000 8\n\n"
+                    "# version 30001\n\ndata_particles\n\nloop_\n_rlnImageName #1\n_rlnMicrographName #2\n"
+                    "_rlnImageId #3\n_rlnOpticsGroup #4\n")
+            for rowIdx, (i, name) in enumerate(self.rows):
+                f.write("%06d@%s 'mics/mic %d.mrc' %d 1\n" % (i + 1, name, rowIdx, 10 * (rowIdx + 1)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _split(self, seed, chunkSize=7, copy=False, imagePathFunc=None):
+        subsetStars = [os.path.join(self.tmpDir, f"subset_{i}.star") for i in range(3)]
+        subsetStacks = [os.path.join(self.tmpDir, f"subset_{i}.mrcs") for i in range(3)] if copy else None
+        useImageIds, subsetKeys = streamSplitStar(self.starFname, subsetStars, seed=seed, subsetStacks=subsetStacks,
+                                                  imagePathFunc=imagePathFunc, chunkSize=chunkSize)
+        self.assertTrue(useImageIds)
+        return subsetStars, subsetStacks, [list(keys) for keys in subsetKeys]
+
+    def test_assignSubsets(self):
+        self.assertEqual(list(assignSubsets(np.arange(10), 3, 10)), [0, 0, 0, 1, 1, 1, 2, 2, 2, 2])
+        hashed = assignSubsets(np.arange(1000), 3, None, seed=5)
+        self.assertEqual(set(hashed), {0, 1, 2})
+        np.testing.assert_array_equal(hashed[100:200], assignSubsets(np.arange(100, 200), 3, None, seed=5))
+        self.assertFalse(np.array_equal(hashed, assignSubsets(np.arange(1000), 3, None, seed=6)))
+
+    def test_reproducible(self):
+        _, _, keys = self._split(seed=3)
+        _, _, keysAgain = self._split(seed=3)
+        _, _, keysOtherChunks = self._split(seed=3, chunkSize=1000)
+        _, _, keysOtherSeed = self._split(seed=4)
+        self.assertEqual(keys, keysAgain)
+        self.assertEqual(keys, keysOtherChunks)
+        self.assertNotEqual(keys, keysOtherSeed)
+        self.assertEqual(sorted(sum(keys, [])), [10 * (i + 1) for i in range(len(self.rows))])
+
+    def test_contiguous(self):
+        _, _, keys = self._split(seed=None)
+        self.assertEqual(sum(keys, []), [10 * (i + 1) for i in range(len(self.rows))])
+        self.assertEqual([len(k) for k in keys], [16, 16, 18])
+
+    def test_starContents(self):
+        subsetStars, _, keys = self._split(seed=3, imagePathFunc=os.path.abspath)
+        for subsetStar, subsetKeys in zip(subsetStars, keys):
+            star = starfile.read(subsetStar)
+            self.assertEqual(len(star["optics"]), 1)
+            self.assertAlmostEqual(star["optics"]["rlnImagePixelSize"][0], 1.5)
+            particles = star["particles"]
+            self.assertEqual(list(particles["rlnImageId"]), subsetKeys)
+            for imageName, micName, imageId in zip(particles["rlnImageName"], particles["rlnMicrographName"],
+                                                   particles["rlnImageId"]):
+                i, name = self.rows[imageId // 10 - 1]
+                self.assertEqual(imageName, "%06d@%s" % (i + 1, os.path.join(self.tmpDir, name)))
+                self.assertEqual(micName, "mics/mic %d.mrc" % (imageId // 10 - 1))
+
+    def test_copyImages(self):
+        subsetStars, subsetStacks, keys = self._split(seed=3, copy=True)
+        for subsetStar, subsetStack, subsetKeys in zip(subsetStars, subsetStacks, keys):
+            data = mrcfile.read(subsetStack).reshape(-1, 8, 8)
+            self.assertEqual(len(data), len(subsetKeys))
+            particles = starfile.read(subsetStar)["particles"]
+            stackName = os.path.basename(subsetStack)
+            self.assertEqual(list(particles["rlnImageName"]),
+                             ["%06d@%s" % (j + 1, stackName) for j in range(len(subsetKeys))])
+            for j, imageId in enumerate(subsetKeys):
+                i, name = self.rows[imageId // 10 - 1]
+                np.testing.assert_array_equal(data[j], self.images[os.path.join(self.tmpDir, name)][i])